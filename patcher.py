@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import itertools
 import os
-import re
 import subprocess
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable
 
 import colors
 
+SUBJECT_PREFIX = "Subject: [PATCH] "
+FEATURE_PREFIX = "Feature: "
+HEAD_BYTES = 4096
+
 
 def repo(*args: str, repo_dir: str) -> int:
     return subprocess.check_call(["repo"] + list(args), cwd=repo_dir)
@@ -30,8 +36,10 @@ def repo_output(*args: str, repo_dir: str, check: bool = True) -> str:
     return data.rstrip("\n")
 
 
-def repo_start(repo_dir: str) -> int:
-    return repo("start", "diamondaosp", repo_dir=repo_dir)
+def repo_start(repo_dir: str) -> str:
+    # Captured together with stderr, where repo reports its progress
+    return subprocess.check_output(["repo", "start", "diamondaosp"], cwd=repo_dir, encoding="UTF-8",
+                                   stderr=subprocess.STDOUT).rstrip("\n")
 
 
 def git(*args: str, repo_dir: str) -> int:
@@ -42,20 +50,85 @@ def git_output(*args: str, repo_dir: str) -> str:
     return subprocess.check_output(["git"] + list(args), cwd=repo_dir, encoding="UTF-8").rstrip("\n")
 
 
-def get_upstream_revision(repo_dir: str) -> str:
-    upstream_revision = repo_output("forall", repo_dir, "-c", f"echo $REPO_LREV", repo_dir=repo_dir)
-    if not upstream_revision:
-        raise Error("manifest_revision_id is empty")
+def get_all_upstream_revisions(project_names: list[str]) -> dict[str, str | None]:
+    # Without any project repo forall would visit the whole tree
+    if not project_names:
+        return {}
+
+    output = repo_output("forall", *project_names, "-c", "printf '%s\\t%s\\n' \"$REPO_PATH\" \"$REPO_LREV\"",
+                         repo_dir=get_top(),
+                         check=False)
+
+    upstream_revisions = dict[str, str | None].fromkeys(project_names)
+    for line in output.splitlines():
+        project_name, _, upstream_revision = line.partition("\t")
+        if upstream_revision:
+            upstream_revisions[project_name] = upstream_revision
+
+    return upstream_revisions
+
+
+def is_signing_disabled(repo_dir: str) -> bool:
+    try:
+        with open(os.path.join(repo_dir, ".git", "config"), "r", encoding="UTF-8") as f:
+            config_lines = f.readlines()
+    except OSError:
+        return False
+
+    gpgsign: str | None = None
+    in_commit_section = False
+
+    for line in config_lines:
+        line = line.strip()
+
+        if line.startswith("["):
+            in_commit_section = line.lower() == "[commit]"
+        elif in_commit_section:
+            key, _, value = line.partition("=")
+            if key.strip().lower() == "gpgsign":
+                gpgsign = value.strip().lower()
 
-    return upstream_revision
+    return gpgsign in ("false", "no", "off", "0")
 
 
 def disable_signing(repo_dir: str):
+    if is_signing_disabled(repo_dir):
+        return
+
     git("config", "--local", "commit.gpgsign", "false", repo_dir=repo_dir)
 
 
-top = repo_output("--show-toplevel", repo_dir=os.getcwd())
-projects_dir = os.path.join(top, ".repo", "manifests", "patches")
+@functools.lru_cache(maxsize=1)
+def get_top() -> str:
+    # Same lookup as repo's own, which requires .repo/repo/main.py
+    current_dir = os.getcwd()
+    while True:
+        if os.path.isfile(os.path.join(current_dir, ".repo", "repo", "main.py")):
+            return current_dir
+
+        parent_dir = os.path.dirname(current_dir)
+        if parent_dir == current_dir:
+            break
+
+        current_dir = parent_dir
+
+    return repo_output("--show-toplevel", repo_dir=os.getcwd())
+
+
+@functools.lru_cache(maxsize=1)
+def get_projects_dir() -> str:
+    return os.path.join(get_top(), ".repo", "manifests", "patches")
+
+
+@functools.lru_cache(maxsize=4096)
+def check_project_dir(project_dir: str) -> str | None:
+    if os.path.isdir(os.path.join(project_dir, ".git")):
+        return None
+
+    if not os.path.isdir(project_dir):
+        return "doesn't exist"
+
+    return "isn't a git repo"
 
 
 @dataclass
@@ -66,12 +139,9 @@ class Project:
 
     @staticmethod
     def ensure_dir_is_valid(project_dir: str) -> bool:
-        if not os.path.isdir(project_dir):
-            print(f"{colors.RED}Project {colors.CYAN}{project_dir}{colors.RED} doesn't exist{colors.RESET}")
-            return False
-
-        if not os.path.isdir(os.path.join(project_dir, ".git")):
-            print(f"{colors.RED}Project {colors.CYAN}{project_dir}{colors.RED} isn't a git repo{colors.RESET}")
+        problem = check_project_dir(project_dir)
+        if problem is not None:
+            print(f"{colors.RED}Project {colors.CYAN}{project_dir}{colors.RED} {problem}{colors.RESET}")
             return False
 
         return True
@@ -79,16 +149,29 @@ class Project:
 
 def discover_projects():
     projects = dict[str, Project]()
+    projects_dir = get_projects_dir()
+
+    pending_dirs = [projects_dir]
+    while pending_dirs:
+        patches_dir = pending_dirs.pop()
+        has_files = False
+
+        with os.scandir(patches_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.') and entry.name != "__pycache__":
+                        pending_dirs.append(entry.path)
+                else:
+                    has_files = True
 
-    for patches_dir, _, files in os.walk(projects_dir):
         if patches_dir == projects_dir:
             continue
 
-        if len(files) <= 0:
+        if not has_files:
             continue
 
         relative_path = os.path.relpath(patches_dir, projects_dir)
-        project_dir = os.path.join(top, relative_path)
+        project_dir = os.path.join(get_top(), relative_path)
 
         if not Project.ensure_dir_is_valid(project_dir):
             continue
@@ -103,7 +186,7 @@ def get_target_projects(projects: dict[str, Project], project_names: list[str]):
 
     if project_names:
         target_projects: list[Project] = []
-        for name in project_names:
+        for name in dict.fromkeys(project_names):
             project = projects.get(name)
             if project:
                 target_projects.append(project)
@@ -116,136 +199,275 @@ def get_target_projects(projects: dict[str, Project], project_names: list[str]):
 
 
 def init(projects: dict[str, Project], args):
-    project_name: str = os.path.relpath(args.project, top)
+    project_name: str = os.path.relpath(args.project, get_top())
 
-    project_dir = os.path.join(top, project_name)
+    project_dir = os.path.join(get_top(), project_name)
 
     if not Project.ensure_dir_is_valid(project_dir):
         return
 
     if project_name not in projects:
-        patches_dir = os.path.join(projects_dir, project_name)
+        patches_dir = os.path.join(get_projects_dir(), project_name)
         os.makedirs(patches_dir, exist_ok=True)
         os.close(os.open(os.path.join(patches_dir, ".keep"), os.O_CREAT))
 
     disable_signing(project_dir)
-    repo_start(project_dir)
 
+    start_output = repo_start(project_dir)
+    if start_output:
+        print(start_output)
 
-@dataclass
-class Patch:
-    project: Project
-    file_name: str
-    feature: str | None
-    message: str
+
+def parse_patch_headers(patch_path: str) -> tuple[str | None, str]:
+    subject: str | None = None
+    feature: str | None = None
+
+    fd = os.open(patch_path, os.O_RDONLY)
+    try:
+        head = b""
+        while True:
+            chunk = os.read(fd, HEAD_BYTES)
+            head += chunk
+            if not chunk or b"\n---\n" in head:
+                break
+    finally:
+        os.close(fd)
+
+    commit_message = head.decode("UTF-8", "replace").split("\n---\n", 1)[0]
+
+    for line in commit_message.splitlines():
+        if subject is None:
+            if line.startswith(SUBJECT_PREFIX):
+                subject = line[len(SUBJECT_PREFIX):]
+        elif line.startswith(FEATURE_PREFIX):
+            feature = line[len(FEATURE_PREFIX):]
+            break
+
+    if subject is None:
+        raise ValueError(f"{patch_path} has no subject")
+
+    return feature, subject
 
 
 def update_readme(projects: dict[str, Project]):
-    patches_readme = os.path.join(projects_dir, "README.md")
+    patches_readme = os.path.join(get_projects_dir(), "README.md")
     if os.path.isfile(patches_readme):
-        features: dict[str | None, list[Patch]] = dict()
-
-        for relative_path, project in projects.items():
-            for patch_file_name in os.listdir(project.patches_dir):
-                patch_text = Path(os.path.join(project.patches_dir, patch_file_name)).read_text()
+        patch_files: list[tuple[str, str, str]] = []
+        for project in projects.values():
+            with os.scandir(project.patches_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.patch'):
+                        patch_files.append((project.name, entry.name, entry.path))
 
-                message = re.search("Subject: \[PATCH\] (.+)$", patch_text, re.MULTILINE).group(1)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            headers = executor.map(parse_patch_headers, [path for _, _, path in patch_files])
 
-                feature_match = re.search(r"Feature: (.+)$", patch_text, re.MULTILINE)
-                feature = feature_match.group(1) if feature_match else None
+            # (feature, project name, file name, message)
+            patches = [(feature, project_name, file_name, message)
+                       for (project_name, file_name, _), (feature, message) in zip(patch_files, headers)]
 
-                features.setdefault(feature, []).append(Patch(project, patch_file_name, feature, message))
+        # Patches without a feature go last, under miscellaneous
+        patches.sort(key=lambda patch: (patch[0] is None, patch[0] or "", patch[1], patch[2]))
 
         with open(patches_readme, "w") as f:
-            def write_feature(feature: str, patches: list[Patch]):
-                f.write(f"## {feature}\n\n")
-                for patch in patches:
-                    path = f"./{patch.project.name}/{patch.file_name}"
+            for feature, feature_patches in itertools.groupby(patches, key=lambda patch: patch[0]):
+                f.write(f"## {feature if feature is not None else 'miscellaneous'}\n\n")
+                for _, project_name, file_name, message in feature_patches:
+                    path = f"./{project_name}/{file_name}"
                     f.write(
-                        f"- [`{patch.project.name}` {patch.message}]({path})\n"
+                        f"- [`{project_name}` {message}]({path})\n"
                     )
                 f.write("\n")
 
-            miscellaneous: list[Patch] | None
 
-            for feature, patches in features.items():
-                if feature is not None:
-                    write_feature(feature, patches)
-                else:
-                    miscellaneous = patches
+def run_project_task(task: Callable[[Project, str, list[str]], None], project: Project,
+                     upstream_revision: str | None) -> tuple[list[str], bool]:
+    output: list[str] = []
 
-            if miscellaneous is not None:
-                write_feature("miscellaneous", miscellaneous)
+    try:
+        if upstream_revision is None:
+            raise ValueError(f"manifest_revision_id of {project.name} is empty")
 
+        task(project, upstream_revision, output)
+    except Exception as ex:
+        if isinstance(ex, subprocess.CalledProcessError) and ex.output:
+            output.append(ex.output.rstrip("\n"))
 
-def rebuild(projects: dict[str, Project], args):
-    for project in get_target_projects(projects, args.project):
-        print(f"Rebuilding patches for {colors.CYAN}{project.name}{colors.RESET}")
+        output.append(f"{colors.RED}Failed on {colors.CYAN}{project.name}{colors.RED}: {ex}{colors.RESET}")
+        return output, False
 
-        if os.path.isdir(os.path.join(project.dir, ".git", "rebase-apply")):
-            raise NotImplementedError("handle rebases is not implemented")
+    return output, True
 
-        upstream_revision = get_upstream_revision(project.dir)
-        print(f"  Upstream revision: {colors.CYAN}{upstream_revision}{colors.RESET}")
 
-        patches_dir = project.patches_dir
+def rebuild_one(project: Project, upstream_revision: str, output: list[str]):
+    output.append(f"Rebuilding patches for {colors.CYAN}{project.name}{colors.RESET}")
 
-        for file in os.listdir(patches_dir):
-            if file.endswith('.patch') or file == ".keep":
-                os.remove(os.path.join(patches_dir, file))
+    if os.path.isdir(os.path.join(project.dir, ".git", "rebase-apply")):
+        raise NotImplementedError("handle rebases is not implemented")
 
-        git("format-patch", "--quiet",
-            "--no-stat", "--no-numbered", "--zero-commit", "--full-index", "--no-signature",
-            "-o", patches_dir,
-            upstream_revision,
-            repo_dir=project.dir)
+    output.append(f"  Upstream revision: {colors.CYAN}{upstream_revision}{colors.RESET}")
 
-        [print(f"  {colors.CYAN}{file}{colors.RESET}") for file in os.listdir(patches_dir) if file.endswith('.patch')]
+    patches_dir = project.patches_dir
 
-    update_readme(projects)
+    with os.scandir(patches_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.patch'):
+                os.remove(entry.path)
 
+    # format-patch prints the path of every patch it writes
+    patch_paths = git_output("format-patch",
+                             "--no-stat", "--no-numbered", "--zero-commit", "--full-index", "--no-signature",
+                             "-o", patches_dir,
+                             upstream_revision,
+                             repo_dir=project.dir)
 
-def apply(projects: dict[str, Project], args):
-    for i, project in enumerate(get_target_projects(projects, args.project)):
-        if i > 0:
-            print()
+    for patch_path in patch_paths.splitlines():
+        output.append(f"  {colors.CYAN}{os.path.basename(patch_path)}{colors.RESET}")
 
-        if git_output("status", "--porcelain=v1", repo_dir=project.dir) != "":
-            print(
-                f"{colors.RED}There are uncommited changes in {colors.CYAN}{project.name}{colors.RED}, skipping{colors.RESET}")
-            continue
 
-        print(f"Applying patches to {colors.CYAN}{project.name}{colors.RESET}")
+def rebuild(projects: dict[str, Project], args):
+    target_projects = list(get_target_projects(projects, args.project))
+    upstream_revisions = get_all_upstream_revisions([project.name for project in target_projects])
 
-        if os.path.isdir(os.path.join(project.dir, ".git", "rebase-apply")):
-            git("am", "--abort", repo_dir=project.dir)
+    failed = False
 
-        disable_signing(project.dir)
-        repo_start(project.dir)
+    with ThreadPoolExecutor(max_workers=min(32, len(target_projects) or 1)) as executor:
+        for output, succeeded in executor.map(run_project_task, itertools.repeat(rebuild_one), target_projects,
+                                              [upstream_revisions[project.name] for project in target_projects]):
+            print("\n".join(output))
+            failed |= not succeeded
 
-        upstream_revision = get_upstream_revision(project.dir)
+    update_readme(projects)
 
-        reset_output = git_output("reset", "--keep", upstream_revision, repo_dir=project.dir)
-        print(f"Reset to {upstream_revision}: " + reset_output)
+    if failed:
+        sys.exit(1)
 
-        patches = [os.path.abspath(os.path.join(project.patches_dir, p)) for p in os.listdir(project.patches_dir)]
-        git("am", "--3way", "--ignore-whitespace", *patches, repo_dir=project.dir)
 
-    if not args.project:
-        patched_projects = repo_output(
+def read_head(project_dir: str) -> str | None:
+    git_dir = os.path.join(project_dir, ".git")
+
+    try:
+        # Worktree checkouts have a .git file pointing to the real git directory
+        if os.path.isfile(git_dir):
+            with open(git_dir, "r", encoding="UTF-8") as f:
+                git_dir = os.path.join(project_dir, f.read().removeprefix("gitdir:").strip())
+
+        with open(os.path.join(git_dir, "HEAD"), "r", encoding="UTF-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def get_patched_project_names() -> list[str]:
+    top = get_top()
+    repo_projects_dir = os.path.join(top, ".repo", "projects")
+
+    if not os.path.isdir(repo_projects_dir):
+        return repo_output(
             "forall", "-c",
             "[[ \"$(git rev-parse --abbrev-ref HEAD)\" == \"diamondaosp\" ]] && echo $REPO_PATH",
             repo_dir=top,
             check=False).split("\n")
-        no_longer_patched_projects = list(filter(lambda p: not projects.get(p), patched_projects))
+
+    patched_project_names: list[str] = []
+
+    pending_dirs = [repo_projects_dir]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+
+                if not entry.name.endswith(".git"):
+                    pending_dirs.append(entry.path)
+                    continue
+
+                project_name = os.path.relpath(entry.path, repo_projects_dir).removesuffix(".git")
+                if read_head(os.path.join(top, project_name)) == "ref: refs/heads/diamondaosp\n":
+                    patched_project_names.append(project_name)
+
+    if not patched_project_names:
+        return patched_project_names
+
+    # .repo/projects also keeps projects that were dropped from the manifest
+    manifest_project_names = set(repo_output("list", "--path-only", repo_dir=top, check=False).splitlines())
+    return [name for name in patched_project_names if name in manifest_project_names]
+
+
+def apply_one(project: Project, upstream_revision: str, output: list[str]):
+    if git_output("status", "--porcelain=v1", repo_dir=project.dir) != "":
+        output.append(
+            f"{colors.RED}There are uncommited changes in {colors.CYAN}{project.name}{colors.RED}, skipping{colors.RESET}")
+        return
+
+    output.append(f"Applying patches to {colors.CYAN}{project.name}{colors.RESET}")
+
+    if os.path.isdir(os.path.join(project.dir, ".git", "rebase-apply")):
+        git_output("am", "--abort", repo_dir=project.dir)
+
+    disable_signing(project.dir)
+    start_output = repo_start(project.dir)
+    if start_output:
+        output.append(start_output)
+
+    reset_output = git_output("reset", "--keep", upstream_revision, repo_dir=project.dir)
+    output.append(f"Reset to {upstream_revision}: " + reset_output)
+
+    with os.scandir(project.patches_dir) as entries:
+        patches = sorted(entry.path for entry in entries if entry.name.endswith('.patch'))
+    if not patches:
+        return
+
+    # format-patch files are mboxes, so they concatenate into a single mbox
+    mbox = bytearray()
+    for patch in patches:
+        with open(patch, "rb") as f:
+            mbox += f.read()
+
+    am = subprocess.run(["git", "am", "--3way", "--ignore-whitespace"],
+                        cwd=project.dir, input=mbox, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    am_output = am.stdout.decode("UTF-8", "replace").rstrip("\n")
+    if am_output:
+        output.append(am_output)
+
+    if am.returncode != 0:
+        raise subprocess.CalledProcessError(am.returncode, am.args)
+
+
+def apply(projects: dict[str, Project], args):
+    target_projects = list(get_target_projects(projects, args.project))
+    upstream_revisions = get_all_upstream_revisions([project.name for project in target_projects])
+
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=min(8, len(target_projects) or 1)) as executor:
+        results = executor.map(run_project_task, itertools.repeat(apply_one), target_projects,
+                               [upstream_revisions[project.name] for project in target_projects])
+
+        for i, (output, succeeded) in enumerate(results):
+            if i > 0:
+                print()
+
+            print("\n".join(output))
+            failed |= not succeeded
+
+    if not args.project:
+        patched_projects = get_patched_project_names()
+        no_longer_patched_projects = list(filter(lambda p: p and not projects.get(p), patched_projects))
         if no_longer_patched_projects:
             print(f"Reverting {colors.CYAN}{' '.join(no_longer_patched_projects)}{colors.RESET}")
-            repo("abandon", "--quiet", "diamondaosp", *no_longer_patched_projects, repo_dir=top)
+            try:
+                repo("abandon", "--quiet", "diamondaosp", *no_longer_patched_projects, repo_dir=get_top())
+            except subprocess.CalledProcessError as ex:
+                print(f"{colors.RED}Failed to revert {colors.CYAN}{' '.join(no_longer_patched_projects)}"
+                      f"{colors.RED}: {ex}{colors.RESET}")
+                failed = True
 
+    if failed:
+        sys.exit(1)
 
-def main():
-    projects = discover_projects()
 
+def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(required=True)
 
@@ -262,7 +484,7 @@ def main():
     apply_parser.set_defaults(func=apply)
 
     args = parser.parse_args()
-    args.func(projects, args)
+    args.func(discover_projects(), args)
 
 
 if __name__ == '__main__':